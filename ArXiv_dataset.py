@@ -3,25 +3,42 @@ This script generates a Hugging Face Dataset from ArXiv research papers.
 The research papers need to be downloaded separately using the ArXiv bulk data download.
 """
 
+import collections
+import concurrent.futures
 import csv
+import functools
 import json
 import os
 import tarfile
 import gzip
-import io
 import logging
+import mmap
+import multiprocessing
+import queue
 import re
+import threading
+import uuid
 
 import datasets
 
+try:
+    # isa-l and zlib-ng inflate much faster than the system zlib, use one if it is installed
+    from isal import igzip as _gzip
+except ImportError:
+    try:
+        from zlib_ng import gzip_ng as _gzip
+    except ImportError:
+        _gzip = gzip
+
+# Regular expression used to parse the dates out of the bulk download tar filenames
+_TAR_NAME_PATTERN = re.compile(r'arXiv_src_(\d{2})(\d{2})_(\d{3})\.tar')
+
 def sort_by_date(filenames):
     """Sorts a list of tar filenames by date"""
-    # Use a regular expression to parse the dates
-    pattern = re.compile(r'arXiv_src_(\d{2})(\d{2})_(\d{3})\.tar')
 
     def get_date(filename):
         """Extracts a date tuple from a filename"""
-        match = pattern.match(filename)
+        match = _TAR_NAME_PATTERN.match(filename)
         if match is None:
             return 0, 0, 0  # if the filename does not match, return a dummy value
         year, month, number = match.groups()
@@ -34,6 +51,195 @@ def sort_by_date(filenames):
 
     return sorted(filenames, key=get_date)
 
+# Directory (inside the dataset directory) holding the cached tar member indexes
+_INDEX_DIRNAME = ".arxiv_index"
+
+def build_tar_index(tar_path):
+    """Returns the (name, offset_data, size) of every .gz member of a tar file, sorted by name"""
+    members = []
+    with tarfile.open(tar_path, 'r') as tar:
+        # Walk the headers one at a time.  TarFile remembers every TarInfo it reads, so the list
+        # is emptied as we go to keep memory flat on tars with many members.
+        member = tar.next()
+        while member is not None:
+            if member.name.endswith('.gz'):
+                members.append((member.name, member.offset_data, member.size))
+            tar.members = []
+            member = tar.next()
+    return sorted(members)
+
+def load_tar_index(filepath, tarfilename):
+    """Loads the member index of a tar file from its on-disk cache, building it on a miss.
+
+    The cache is keyed by the tar's mtime and size so a re-downloaded tar is re-indexed.
+    """
+    tar_path = os.path.join(filepath, tarfilename)
+    stat = os.stat(tar_path)
+    cache_key = [stat.st_mtime_ns, stat.st_size]
+    index_dir = os.path.join(filepath, _INDEX_DIRNAME)
+    index_path = os.path.join(index_dir, f"{tarfilename}.idx.json")
+    try:
+        with open(index_path, 'r') as f:
+            cached = json.load(f)
+        if cached["key"] == cache_key:
+            return [(name, offset_data, size) for name, offset_data, size in cached["members"]]
+    except (OSError, ValueError, TypeError, KeyError):
+        pass  # missing or unreadable cache, rebuild it
+
+    members = build_tar_index(tar_path)
+    try:
+        os.makedirs(index_dir, exist_ok=True)
+        # Write to a temporary file and swap it in, so a concurrent build or a crash
+        # never leaves a partial index behind.  It is created with open() rather than mkstemp()
+        # so it gets the umask permissions and stays readable in a shared dataset directory.
+        tmp_path = os.path.join(index_dir, f".{tarfilename}.{uuid.uuid4().hex}.tmp")
+        try:
+            with open(tmp_path, 'x') as f:
+                json.dump({"key": cache_key, "members": members}, f)
+            os.replace(tmp_path, index_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+    except OSError as e:
+        # A read-only dataset directory only costs us the re-indexing on the next run.
+        logging.warning(f"Could not write tar index: {index_path}. Error: {str(e)}")
+    return members
+
+def _member_info(name, offset_data, size):
+    """Rebuilds the TarInfo needed to extract an indexed member without rescanning the tar.
+
+    Always pass the result to extractfile(), a member name would make it scan the whole tar.
+    """
+    info = tarfile.TarInfo(name)
+    info.offset_data = offset_data
+    info.size = size
+    return info
+
+# Number of outer tars each worker process keeps open between tasks
+_MAX_OPEN_TARS = 4
+
+# Open outer tars of the current worker process, least recently used first
+_open_tars = collections.OrderedDict()
+
+def _open_tar(tar_path):
+    """Returns an open outer tar, reusing the handles this process opened recently.
+
+    The tar is read through a memory map, so member bytes come straight from the page cache
+    instead of being copied through a userland read buffer first.
+    """
+    if tar_path in _open_tars:
+        _open_tars.move_to_end(tar_path)
+        return _open_tars[tar_path][0]
+    with open(tar_path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mapped, 'madvise'):
+        # Workers read runs of consecutive members, let the kernel read ahead
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
+    tar = tarfile.open(tar_path, 'r', fileobj=mapped)
+    _open_tars[tar_path] = (tar, mapped)
+    if len(_open_tars) > _MAX_OPEN_TARS:
+        _, (old_tar, old_mapped) = _open_tars.popitem(last=False)
+        old_tar.close()
+        old_mapped.close()
+    return tar
+
+def _extract_main_tex(task, decode_content=True):
+    """Extracts 'main.tex' from one indexed gz member of an outer tar.
+
+    Runs in a worker process, so instead of logging it returns an (example, error) pair.
+    The example is None when the submission has no 'main.tex'.  Its content is left as
+    raw bytes unless decode_content is set.
+    """
+    tar_path, name, offset_data, size = task
+    try:
+        # Stream the gz file straight out of the outer tar instead of buffering it
+        gz_file_stream = _open_tar(tar_path).extractfile(_member_info(name, offset_data, size))
+
+        # Inflate the stream and open it as a tarfile.  Streaming mode reads the headers in order,
+        # so we can stop inflating as soon as 'main.tex' has been found.
+        with _gzip.open(gz_file_stream, 'rb') as tar_file_stream, \
+                tarfile.open(fileobj=tar_file_stream, mode='r|') as inner_tar:
+            # Iterate over the items in the tar file
+            for inner_member in inner_tar:
+                # Only process 'main.tex' files (not directories or other files)
+                if inner_member.isfile() and inner_member.name == 'main.tex':
+                    # Extract file data
+                    file_data = inner_tar.extractfile(inner_member).read()
+
+                    # Return the id (filename without extension) and content of the tex file
+                    return {
+                        "id": inner_member.name[:-3],
+                        "content": file_data.decode('utf-8') if decode_content else file_data
+                    }, None
+    except Exception as e:
+        return None, str(e)
+    return None, None
+
+class _PrefetchedIterator:
+    """ Advances an iterator in a background thread, keeping up to maxsize items ahead of the consumer.
+    """
+
+    # Marks the end of the iterator in the queue
+    _END = object()
+
+    def __init__(self, iterator, maxsize=16):
+        self._queue = queue.Queue(maxsize)
+        self._stopped = threading.Event()
+        self._done = False
+        self._thread = threading.Thread(target=self._fill, args=(iterator,), daemon=True)
+        self._thread.start()
+
+    def _fill(self, iterator):
+        """ Moves items into the queue until the iterator is exhausted or the consumer stops.
+        """
+        try:
+            for item in iterator:
+                if not self._put((item, None)):
+                    return
+            self._put((self._END, None))
+        except Exception as e:
+            # Hand the error over to the consumer
+            self._put((self._END, e))
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    def _put(self, entry):
+        """ Blocks until the entry is queued, returns False if the consumer stopped first.
+        """
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._done:
+            raise StopIteration
+        item, error = self._queue.get()
+        if item is self._END:
+            self._done = True
+            if error is not None:
+                raise error
+            raise StopIteration
+        return item
+
+    def close(self):
+        """ Stops the background thread and waits for it to close the iterator.
+
+        The thread first finishes the item it is advancing to, so this blocks for as long as the
+        iterator's own close, plus at most one item.  The iterator must keep that bounded itself.
+        """
+        self._done = True
+        self._stopped.set()
+        self._thread.join()
+
 # Create a custom logger
 logger = logging.getLogger(__name__)
 
@@ -56,6 +262,20 @@ _LICENSE = "https://info.arxiv.org/help/license/index.html"
 _URLS = [os.environ["ARXIV_DATASET_PATH"]]
 
 
+class ArXivConfig(datasets.BuilderConfig):
+    """ BuilderConfig for the ArXiv research papers.
+    """
+
+    def __init__(self, decode_content=True, num_workers=None, **kwargs):
+        """ decode_content selects whether the tex content is decoded to a string or kept as raw bytes.
+        num_workers is the number of processes decoding the gz files, all cores when None and
+        in the generating process itself when 0.
+        """
+        super().__init__(**kwargs)
+        self.decode_content = decode_content
+        self.num_workers = num_workers
+
+
 class ArXivDataset(datasets.GeneratorBasedBuilder):
     """ A custom Hugging Face Dataset class for ArXiv research papers.
     """
@@ -63,6 +283,17 @@ class ArXivDataset(datasets.GeneratorBasedBuilder):
     # Version of the dataset
     VERSION = datasets.Version("0.0.2")
 
+    BUILDER_CONFIGS = [
+        # Keeps the name datasets gave the builder before it had configs, so existing caches stay valid
+        ArXivConfig(name="default", version=VERSION, decode_content=True,
+                    description="The tex content decoded as UTF-8."),
+        # Skips the UTF-8 decoding for consumers such as fast tokenizers that take the bytes directly
+        ArXivConfig(name="raw", version=VERSION, decode_content=False,
+                    description="The tex content as raw bytes."),
+    ]
+
+    DEFAULT_CONFIG_NAME = "default"
+
     def _info(self):
         """ Returns dataset information such as features, homepage, license, and citation.
         """
@@ -70,7 +301,7 @@ class ArXivDataset(datasets.GeneratorBasedBuilder):
             description=_DESCRIPTION,
             features=datasets.Features({
                 "id": datasets.Value("string"),
-                "content": datasets.Value("string")
+                "content": datasets.Value("string" if self.config.decode_content else "binary")
             }),
             homepage=_HOMEPAGE,
             license=_LICENSE,
@@ -93,36 +324,52 @@ class ArXivDataset(datasets.GeneratorBasedBuilder):
     def _generate_examples(self, filepath):
         """ Generates dataset examples by iterating over tar files in the filepath and extracting relevant data.
         """
+        # Keep decoding in the background while the examples are consumed, otherwise the pool
+        # idles whenever the consumer is busy, e.g. at every tar boundary.
+        examples = _PrefetchedIterator(self._iter_examples(filepath), maxsize=16)
+        try:
+            yield from examples
+        finally:
+            examples.close()
+
+    def _iter_examples(self, filepath):
+        """ Iterates over the (key, example) pairs of every tar file in the filepath, newest tar first.
+        """
         key = 0
-        for tar in reversed(sort_by_date(os.listdir(filepath))):
-            # Skip non-tar files and hidden files
-            if not tar.endswith(".tar") or tar.startswith("."):
-                logging.info(f"Skipped non-tar or hidden file: {tar}")
-                continue
-
-            with tarfile.open(os.path.join(filepath, tar), 'r') as outer_tar:
-                # Extract the gz file into a BytesIO stream
-                ordered_members = sorted([f for f in outer_tar.getmembers() if f.name.endswith('.gz')], key=lambda f: f.name)
-                for member in ordered_members:
-                    gz_file_data = outer_tar.extractfile(member).read()
-                    gz_file_stream = io.BytesIO(gz_file_data)
-
-                    try:
-                        # Open the stream as a tarfile
-                        with tarfile.open(fileobj=gz_file_stream, mode='r:gz') as inner_tar:
-                            # Iterate over the items in the tar file
-                            for inner_member in inner_tar.getmembers():
-                                # Only process 'main.tex' files (not directories or other files)
-                                if inner_member.isfile() and inner_member.name == 'main.tex':
-                                    # Extract file data
-                                    file_data = inner_tar.extractfile(inner_member).read()
-
-                                    # Yield the id (filename without extension) and content of the tex file
-                                    yield key, {
-                                        "id": inner_member.name[:-3],
-                                        "content": file_data.decode('utf-8')
-                                    }
-                                    key += 1
-                    except Exception as e:
+        num_workers = os.cpu_count() if self.config.num_workers is None else self.config.num_workers
+        if multiprocessing.current_process().daemon:
+            # Daemonic processes, e.g. the workers of a PyTorch DataLoader over a streaming
+            # dataset, are not allowed to start a pool of their own.
+            num_workers = 0
+        if num_workers:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=num_workers)
+            map_tasks = functools.partial(executor.map, chunksize=16)
+        else:
+            executor = None
+            map_tasks = map
+        try:
+            for tar in reversed(sort_by_date(os.listdir(filepath))):
+                # Skip non-tar files and hidden files
+                if not tar.endswith(".tar") or tar.startswith("."):
+                    logging.info(f"Skipped non-tar or hidden file: {tar}")
+                    continue
+
+                tar_path = os.path.join(filepath, tar)
+                tasks = [(tar_path, *entry) for entry in load_tar_index(filepath, tar)]
+                # Inflating the gz files is CPU bound and independent per submission, so it is
+                # spread over the worker processes if there are any.  Both maps keep the results
+                # in member order.
+                extract_main_tex = functools.partial(_extract_main_tex, decode_content=self.config.decode_content)
+                results = map_tasks(extract_main_tex, tasks)
+                for (_, name, _, _), (example, error) in zip(tasks, results):
+                    if error is not None:
                         # If there's an error reading a gz file, we skip it.
-                        logging.error(f"Error processing file: {tar}/{member.name}. Error: {str(e)}")
\ No newline at end of file
+                        logging.error(f"Error processing file: {tar}/{name}. Error: {error}")
+                    elif example is not None:
+                        yield key, example
+                        key += 1
+        finally:
+            if executor is not None:
+                # map() queues the whole tar up front, cancel what has not started so that closing
+                # the generator early only waits for the chunks already being decoded.
+                executor.shutdown(wait=True, cancel_futures=True)
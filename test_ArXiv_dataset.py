@@ -0,0 +1,57 @@
+"""
+Checks that the ArXiv dataset builder can generate examples from inside a daemonic process,
+as it does in the workers of a PyTorch DataLoader over a streaming dataset.
+"""
+
+import io
+import multiprocessing
+import os
+import tarfile
+import tempfile
+
+
+def make_submission(content):
+    """Returns the bytes of a gz submission containing a 'main.tex' with the given content"""
+    stream = io.BytesIO()
+    with tarfile.open(fileobj=stream, mode='w:gz') as tar:
+        for name, data in [('figure.eps', b'%!PS'), ('main.tex', content)]:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return stream.getvalue()
+
+
+def make_bulk_tar(path, num_submissions):
+    """Writes a bulk download tar of gz submissions to the given path"""
+    with tarfile.open(path, 'w') as tar:
+        for i in range(num_submissions):
+            data = make_submission(f'paper {i}'.encode())
+            info = tarfile.TarInfo(f'{i:04d}.gz')
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+
+def generate_examples(data_dir, cache_dir, results):
+    """Counts the examples generated from data_dir and reports the count on the results queue"""
+    os.environ["ARXIV_DATASET_PATH"] = data_dir
+    import ArXiv_dataset
+    builder = ArXiv_dataset.ArXivDataset(cache_dir=cache_dir)
+    results.put(sum(1 for _ in builder._generate_examples(data_dir)))
+
+
+def test_generate_examples_in_daemon_process():
+    with tempfile.TemporaryDirectory() as data_dir, tempfile.TemporaryDirectory() as cache_dir:
+        make_bulk_tar(os.path.join(data_dir, 'arXiv_src_2301_001.tar'), 36)
+        make_bulk_tar(os.path.join(data_dir, 'arXiv_src_2302_001.tar'), 36)
+
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=generate_examples, args=(data_dir, cache_dir, results), daemon=True)
+        process.start()
+        process.join(timeout=120)
+        assert process.exitcode == 0
+        assert results.get(timeout=1) == 72
+
+
+if __name__ == "__main__":
+    test_generate_examples_in_daemon_process()
+    print("ok")